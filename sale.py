@@ -1,10 +1,13 @@
 # This file is part of the sale_payment module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from collections import defaultdict
+from itertools import chain
 from decimal import Decimal
 from sql.aggregate import Sum
 from sql.conditionals import Coalesce
 
+from trytond import backend
 from trytond.model import ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Bool, Eval, Not
@@ -12,6 +15,7 @@ from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import reduce_ids, grouped_slice
 
 
 __all__ = ['Sale', 'SalePaymentForm', 'WizardSalePayment',
@@ -22,9 +26,9 @@ class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
     payments = fields.One2Many('account.statement.line', 'sale', 'Payments')
     paid_amount = fields.Function(fields.Numeric('Paid Amount', readonly=True),
-        'get_paid_amount')
+        'get_amounts')
     residual_amount = fields.Function(fields.Numeric('Residual Amount'),
-        'get_residual_amount', searcher='search_residual_amount')
+        'get_amounts', searcher='search_residual_amount')
     sale_device = fields.Many2One('sale.device', 'Sale Device',
             domain=[('shop', '=', Eval('shop'))],
             depends=['shop'], states={
@@ -62,37 +66,73 @@ class Sale(metaclass=PoolMeta):
     def set_invoices_to_be_posted(cls, sales):
         pool = Pool()
         Invoice = pool.get('account.invoice')
-        invoices = []
+        Party = pool.get('party.party')
+
+        parties = Party.browse(list({s.party.id for s in sales}))
+        groupings = {p.id: getattr(p, 'sale_invoice_grouping_method', False)
+            for p in parties}
+        to_set = [(sale, invoice)
+            for sale in sales
+            if getattr(sale, 'invoices', None)
+            and not groupings[sale.party.id]
+            for invoice in sale.invoices
+            if invoice.state == 'draft']
+        if not to_set:
+            return
+
+        to_write = {}
+        unhashables = []
         to_post = set()
-        for sale in sales:
-            grouping = getattr(sale.party, 'sale_invoice_grouping_method',
-                False)
-            if getattr(sale, 'invoices', None) and not grouping:
-                for invoice in sale.invoices:
-                    if not invoice.state == 'draft':
-                        continue
-                    sale.set_basic_values_to_invoice(invoice)
-                    invoices.extend(([invoice], invoice._save_values))
-                    to_post.add(invoice)
-
-        if to_post:
-            Invoice.write(*invoices)
-            return list(to_post)
+        for sale, invoice in to_set:
+            if invoice in to_post:
+                continue
+            sale.set_basic_values_to_invoice(invoice)
+            values = invoice._save_values
+            # Group invoices with the same values in one write
+            key = tuple(sorted(values.items()))
+            try:
+                to_write.setdefault(key, (values, []))[1].append(invoice)
+            except TypeError:
+                for write_values, invoices in unhashables:
+                    if write_values == values:
+                        invoices.append(invoice)
+                        break
+                else:
+                    unhashables.append((values, [invoice]))
+            to_post.add(invoice)
+
+        args = []
+        for values, invoices in chain(to_write.values(), unhashables):
+            args.extend((invoices, values))
+        Invoice.write(*args)
+        return list(to_post)
 
     @classmethod
     def workflow_to_end(cls, sales):
+        '''
+        Quote, confirm and process the sales, post their invoices and set
+        them as done when possible.
+        The sales are browsed again in the current context so they are read
+        in batches: values not saved on the given instances and their own
+        context are not kept.
+        '''
         pool = Pool()
         StatementLine = pool.get('account.statement.line')
         Invoice = pool.get('account.invoice')
 
-        for sale in sales:
-            if sale.state == 'draft':
-                cls.quote([sale])
-            if sale.state == 'quotation':
-                cls.confirm([sale])
-            if sale.state == 'confirmed':
-                cls.process([sale])
+        sales = cls.browse([s.id for s in sales])
+
+        to_quote = [s for s in sales if s.state == 'draft']
+        if to_quote:
+            cls.quote(to_quote)
+        to_confirm = [s for s in sales if s.state == 'quotation']
+        if to_confirm:
+            cls.confirm(to_confirm)
+        to_process = [s for s in sales if s.state == 'confirmed']
+        if to_process:
+            cls.process(to_process)
 
+        for sale in sales:
             if not sale.invoices and sale.invoice_method == 'order':
                 raise UserError(gettext(
                     'sale_payment.not_customer_invoice',
@@ -102,47 +142,80 @@ class Sale(metaclass=PoolMeta):
         if to_post:
             Invoice.post(to_post)
 
-        to_write = []
+        to_write = defaultdict(list)
         to_do = []
         for sale in sales:
-            posted_invoice = None
-            for invoice in sale.invoices:
-                if invoice.state == 'posted':
-                    posted_invoice = invoice
-                    break
+            posted_invoice = next(
+                (i for i in sale.invoices if i.state == 'posted'), None)
             if posted_invoice:
+                party_id = posted_invoice.party.id
                 for payment in sale.payments:
                     # Because of account_invoice_party_without_vat module
                     # could be installed, invoice party may be different of
                     # payment party if payment party has not any vat
                     # and both parties must be the same
-                    if payment.party != invoice.party:
-                        payment.party = invoice.party
-                    to_write.extend(([payment], payment._save_values))
+                    if not payment.party or payment.party.id != party_id:
+                        to_write[party_id].append(payment)
 
             if sale.is_done():
                 to_do.append(sale)
 
         if to_write:
-            StatementLine.write(*to_write)
+            args = []
+            for party_id, payments in to_write.items():
+                args.extend((payments, {'party': party_id}))
+            StatementLine.write(*args)
 
         if to_do:
             cls.do(to_do)
 
     @classmethod
-    def get_paid_amount(cls, sales, names):
-        result = {n: {s.id: Decimal(0) for s in sales} for n in names}
-        for name in names:
+    def get_amounts(cls, sales, names):
+        pool = Pool()
+        StatementLine = pool.get('account.statement.line')
+        table = cls.__table__()
+        line = StatementLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        id2sale = {s.id: s for s in sales}
+        paid_amounts = {s.id: Decimal(0) for s in sales}
+        total_amounts = {}
+        for sub_ids in grouped_slice(list(id2sale.keys())):
+            cursor.execute(*table.join(line, type_='LEFT',
+                    condition=line.sale == table.id
+                    ).select(table.id, table.total_amount_cache,
+                    Sum(line.amount),
+                    where=reduce_ids(table.id, sub_ids),
+                    group_by=[table.id, table.total_amount_cache]))
+            for sale_id, total_amount, amount in cursor.fetchall():
+                if total_amount is not None:
+                    total_amounts[sale_id] = total_amount
+                if amount is None:
+                    continue
+                # SQLite uses float for SUM
+                if backend.name == 'sqlite':
+                    amount = id2sale[sale_id].currency.round(
+                        Decimal(str(amount)))
+                paid_amounts[sale_id] = amount
+
+        result = {}
+        if 'paid_amount' in names:
+            result['paid_amount'] = paid_amounts
+        if 'residual_amount' in names:
+            residual_amounts = result['residual_amount'] = {}
             for sale in sales:
-                for payment in sale.payments:
-                    result[name][sale.id] += payment.amount
+                if sale.state == 'cancel':
+                    residual_amounts[sale.id] = Decimal(0)
+                    continue
+                total_amount = None
+                if sale.state in cls._states_cached:
+                    total_amount = total_amounts.get(sale.id)
+                if total_amount is None:
+                    total_amount = sale.total_amount
+                residual_amounts[sale.id] = (
+                    total_amount - paid_amounts[sale.id])
         return result
 
-    @classmethod
-    def get_residual_amount(cls, sales, name):
-        return {s.id: s.total_amount - s.paid_amount if s.state != 'cancel'
-            else Decimal(0) for s in sales}
-
     @classmethod
     def search_residual_amount(cls, name, clause):
         pool = Pool()
@@ -153,26 +226,29 @@ class Sale(metaclass=PoolMeta):
         payline = StatementLine.__table__()
         Operator = fields.SQL_OPERATORS[clause[1]]
         value = clause[2]
-
-        query = sale.join(
-            payline,
-            type_='LEFT',
-            condition=(sale.id == payline.sale)
-            ).select(
-                sale.id,
-                where=((sale.total_amount_cache != None) &
-                    (sale.state.in_([
-                        'draft',
-                        'quotation',
-                        'confirmed',
-                        'processing',
-                        'done']))),
-                group_by=(sale.id),
-                having=(
-                    (Sum(Coalesce(payline.amount, 0)) < sale.total_amount_cache)
-                & Operator(sale.total_amount_cache -
-                    Sum(Coalesce(payline.amount, 0)), value)
-                ))
+        # SQLite uses float for SUM
+        if backend.name == 'sqlite':
+            if isinstance(value, (list, tuple)):
+                value = [float(v) if v is not None else v for v in value]
+            elif value is not None:
+                value = float(value)
+
+        paid_amount = Coalesce(payline.select(Sum(payline.amount),
+                where=payline.sale == sale.id), 0)
+        residuals = sale.select(
+            sale.id,
+            (sale.total_amount_cache - paid_amount).as_('residual_amount'),
+            where=((sale.total_amount_cache != None) &
+                (sale.state.in_([
+                    'draft',
+                    'quotation',
+                    'confirmed',
+                    'processing',
+                    'done']))))
+        query = residuals.select(
+            residuals.id,
+            where=((residuals.residual_amount > 0) &
+                Operator(residuals.residual_amount, value)))
 
         return [('id', 'in', query)]
 
@@ -242,11 +318,12 @@ class WizardSalePayment(Wizard):
         Statement = pool.get('account.statement')
         StatementLine = pool.get('account.statement.line')
 
+        today = Date.today()
         form = self.start
         statements = Statement.search([
                 ('journal', '=', form.journal),
                 ('state', '=', 'draft'),
-                ], order=[('date', 'DESC')])
+                ], order=[('date', 'DESC')], limit=1)
         if not statements:
             raise UserError(gettext('sale_payment.not_draft_statement',
                 journal=form.journal.name))
@@ -254,7 +331,7 @@ class WizardSalePayment(Wizard):
         if not sale.number:
             Sale.set_number([sale])
 
-        with Transaction().set_context(date=Date.today()):
+        with Transaction().set_context(date=today):
             account = sale.party.account_receivable_used
 
         if not account:
@@ -265,7 +342,7 @@ class WizardSalePayment(Wizard):
         if form.payment_amount:
             return StatementLine(
                 statement=statements[0],
-                date=Date.today(),
+                date=today,
                 amount=form.payment_amount,
                 party=sale.party,
                 account=account,
@@ -306,7 +383,28 @@ class WizardSaleReconcile(Wizard):
         pool = Pool()
         Sale = pool.get('sale.sale')
         Line = pool.get('account.move.line')
-        for sale in Sale.browse(Transaction().context['active_ids']):
+
+        sales = Sale.browse(Transaction().context['active_ids'])
+        # A move may group the payments of several sales
+        move2sale = defaultdict(set)
+        for sale in sales:
+            for payment in sale.payments:
+                if payment.move:
+                    move2sale[payment.move.id].add(sale.id)
+        payment_lines = defaultdict(list)
+        if move2sale:
+            accounts = {s.party.account_receivable.id for s in sales
+                if s.party.account_receivable}
+            for line in Line.search([
+                        ('move', 'in', list(move2sale.keys())),
+                        ('account', 'in', list(accounts)),
+                        ('reconciliation', '=', None),
+                        ]):
+                for sale_id in move2sale[line.move.id]:
+                    payment_lines[sale_id].append(line)
+
+        reconciled = set()
+        for sale in sales:
             account = sale.party.account_receivable
             lines = []
             amount = Decimal('0.0')
@@ -315,14 +413,11 @@ class WizardSaleReconcile(Wizard):
                     if not line.reconciliation:
                         lines.append(line)
                         amount += line.debit - line.credit
-            for payment in sale.payments:
-                if not payment.move:
-                    continue
-                for line in payment.move.lines:
-                    if (not line.reconciliation and
-                            line.account.id == account.id):
-                        lines.append(line)
-                        amount += line.debit - line.credit
+            for line in payment_lines[sale.id]:
+                if line.account.id == account.id and line not in reconciled:
+                    lines.append(line)
+                    amount += line.debit - line.credit
             if lines and amount == Decimal('0.0'):
                 Line.reconcile(lines)
+                reconciled.update(lines)
         return 'end'
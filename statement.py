@@ -60,7 +60,8 @@ class Statement(metaclass=PoolMeta):
 
 class Line(metaclass=PoolMeta):
     __name__ = 'account.statement.line'
-    sale = fields.Many2One('sale.sale', 'Sale', ondelete='RESTRICT')
+    sale = fields.Many2One('sale.sale', 'Sale', ondelete='RESTRICT',
+        select=True)
 
     def create_move(self):
         '''
@@ -3,16 +3,180 @@
 # copyright notices and license terms.
 import unittest
 import doctest
+from decimal import Decimal
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
 
 
 class SalePaymentTestCase(ModuleTestCase):
     'Test Sale Payment module'
     module = 'sale_payment'
 
+    @with_transaction()
+    def test_workflow_to_end_several_sales(self):
+        'Test workflow_to_end with several sales'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Date = pool.get('ir.date')
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Location = pool.get('stock.location')
+        Party = pool.get('party.party')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+        PriceList = pool.get('product.price_list')
+        ProductCategory = pool.get('product.category')
+        Sale = pool.get('sale.sale')
+        Sequence = pool.get('ir.sequence')
+        Shop = pool.get('sale.shop')
+        Statement = pool.get('account.statement')
+        StatementJournal = pool.get('account.statement.journal')
+        StatementLine = pool.get('account.statement.line')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            set_invoice_sequences(fiscalyear)
+            FiscalYear.create_period([fiscalyear])
+            today = Date.today()
+
+            receivable, = Account.search([
+                    ('type.receivable', '=', True),
+                    ('company', '=', company.id),
+                    ], limit=1)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('company', '=', company.id),
+                    ], limit=1)
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('company', '=', company.id),
+                    ], limit=1)
+            cash, = Account.search([
+                    ('name', '=', 'Main Cash'),
+                    ('company', '=', company.id),
+                    ])
+
+            unit, = Uom.search([('name', '=', 'Unit')])
+            category, = ProductCategory.create([{
+                        'name': 'Category',
+                        'accounting': True,
+                        'account_revenue': revenue.id,
+                        'account_expense': expense.id,
+                        }])
+            template, = Template.create([{
+                        'name': 'Service',
+                        'type': 'service',
+                        'salable': True,
+                        'list_price': Decimal('10'),
+                        'default_uom': unit.id,
+                        'sale_uom': unit.id,
+                        'account_category': category.id,
+                        'products': [('create', [{}])],
+                        }])
+            product, = template.products
+
+            payment_term, = PaymentTerm.create([{
+                        'name': 'Direct',
+                        'lines': [('create', [{'type': 'remainder'}])],
+                        }])
+            price_list, = PriceList.create([{
+                        'name': 'Default',
+                        }])
+            warehouse, = Location.search([('code', '=', 'WH')])
+            sale_sequence, = Sequence.search([('code', '=', 'sale.sale')])
+            shop, = Shop.create([{
+                        'name': 'Shop',
+                        'warehouse': warehouse.id,
+                        'price_list': price_list.id,
+                        'payment_term': payment_term.id,
+                        'sale_sequence': sale_sequence.id,
+                        'sale_invoice_method': 'order',
+                        'sale_shipment_method': 'order',
+                        }])
+
+            journal_sequence, = Sequence.search([
+                    ('code', '=', 'account.journal'),
+                    ], limit=1)
+            journal, = Journal.create([{
+                        'name': 'Statement',
+                        'type': 'statement',
+                        'sequence': journal_sequence.id,
+                        }])
+            statement_journal, = StatementJournal.create([{
+                        'name': 'Default',
+                        'journal': journal.id,
+                        'account': cash.id,
+                        'currency': company.currency.id,
+                        'validation': 'balance',
+                        }])
+            statement, = Statement.create([{
+                        'name': 'Default',
+                        'journal': statement_journal.id,
+                        'start_balance': Decimal(0),
+                        'end_balance': Decimal(0),
+                        }])
+
+            customer, other_customer = Party.create([{
+                        'name': 'Customer',
+                        'addresses': [('create', [{}])],
+                        }, {
+                        'name': 'Other Customer',
+                        'addresses': [('create', [{}])],
+                        }])
+
+            with Transaction().set_context(shop=shop.id, shops=[shop.id]):
+                sales = Sale.create([{
+                            'shop': shop.id,
+                            'party': party.id,
+                            'invoice_address': party.addresses[0].id,
+                            'shipment_address': party.addresses[0].id,
+                            'payment_term': payment_term.id,
+                            'lines': [('create', [{
+                                            'product': product.id,
+                                            'description': 'Service',
+                                            'quantity': 1,
+                                            'unit': unit.id,
+                                            'unit_price': Decimal('10'),
+                                            }])],
+                            } for party in [
+                            customer, customer, other_customer]])
+                # The payment of the other customer's sale is registered to
+                # the wrong party and must be moved to the invoice party
+                StatementLine.create([{
+                            'statement': statement.id,
+                            'date': today,
+                            'amount': Decimal('10'),
+                            'party': customer.id,
+                            'account': receivable.id,
+                            'sale': sale.id,
+                            } for sale in sales])
+
+                Sale.workflow_to_end(sales)
+
+                sales = Sale.browse([s.id for s in sales])
+                self.assertEqual([s.state for s in sales],
+                    ['processing', 'processing', 'processing'])
+                invoices = [i for s in sales for i in s.invoices]
+                self.assertEqual(len(invoices), 3)
+                self.assertEqual({i.state for i in invoices}, {'posted'})
+                self.assertEqual({i.invoice_date for i in invoices}, {today})
+                for sale in sales:
+                    payment, = sale.payments
+                    self.assertEqual(payment.party, sale.party)
+                self.assertEqual(sales[2].payments[0].party, other_customer)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()